@@ -14,6 +14,9 @@
 
 from .cross_entropy_loss import (
     fast_cross_entropy_loss,
+    fast_linear_cross_entropy,
+    fast_count_valid_labels,
+    CUDAGraphedCE,
     patch_llama_for_causal_lm,
     unpatch_llama_for_causal_lm,
 )
@@ -15,26 +15,63 @@
 import triton
 import triton.language as tl
 import torch
-from .utils import calculate_settings, MAX_FUSED_SIZE, triton_tanh
+from .utils import triton_tanh
 from transformers.models.llama.modeling_llama import logger
 
+# The best num_warps differs a lot per GPU. AMD runs 64 wide wavefronts, so it
+# wants fewer warps, whilst Hopper and newer want at least 8.
+IS_HIP    = torch.version.hip is not None
+IS_HOPPER = (not IS_HIP) and torch.cuda.get_device_capability()[0] >= 9
 
+def _vocab_class(vocab_size):
+    # VOCAB_SIZE is a runtime argument, so every model shares the same compiled
+    # kernels. VOCAB_CLASS is only the autotune key, so we tune once per class:
+    # Llama 2 / Mistral 32K, 64K, Llama 3 128K, then Qwen 152K / Gemma 256K.
+    if   vocab_size <=  32768: return 0
+    elif vocab_size <=  65536: return 1
+    elif vocab_size <= 131072: return 2
+    return 3
+pass
+
+
+def _cross_entropy_configs():
+    if   IS_HIP:    num_warps = (4, 8,)
+    elif IS_HOPPER: num_warps = (8, 16, 32,)
+    else:           num_warps = (4, 8, 16, 32,)
+    # The online softmax does 1 exp and 1 FMA per element, so it is bound by load
+    # latency. 3 or 4 stages let the next tile's loads overlap this tile's reduction.
+    # AMD's stream pipeliner only benefits up to 2 stages.
+    num_stages = (1, 2,) if IS_HIP else (1, 2, 3, 4,)
+    return [
+        triton.Config({"BLOCK_SIZE" : BLOCK_SIZE}, num_warps = w, num_stages = s)
+        for BLOCK_SIZE in (1024, 2048, 4096, 8192,)
+        for w in num_warps
+        for s in num_stages
+    ]
+pass
+
+
+@triton.autotune(
+    configs = _cross_entropy_configs(),
+    key = ["VOCAB_CLASS"],
+)
 @triton.heuristics({
     "DO_SOFTCAPPING":   lambda args: args["DO_SOFTCAPPING"  ],
     "DO_LOGIT_SCALING": lambda args: args["DO_LOGIT_SCALING"],
 })
-@triton.jit
+@triton.jit(do_not_specialize = ["VOCAB_CLASS"])
 def _cross_entropy_forward(
     logits_ptr, logits_row_stride,
-    loss_ptr,
-    logsumexp_ptr,
+    out_ptr,
     labels_ptr,
-    VOCAB_SIZE      : tl.constexpr,
+    VOCAB_SIZE,
+    VOCAB_CLASS,
     BLOCK_SIZE      : tl.constexpr,
     DO_SOFTCAPPING  : tl.constexpr,
     SOFTCAP         : tl.constexpr,
     DO_LOGIT_SCALING: tl.constexpr,
     LOGIT_SCALE     : tl.constexpr,
+    DO_INT64        : tl.constexpr,
 ):
     """
         Cross Entropy Loss = 1/n sum [ -yi log(Pi) ]
@@ -55,39 +92,55 @@ def _cross_entropy_forward(
         This means we can set c = max(x) to make sure
         exp(x - c) always is exp(x - max(x)).
         This ensures exp(x - max(x))'s maximum is 1 as exp(0) = 1.
+
+        We do this in 1 pass over the row with an online softmax.
+        For each BLOCK_SIZE tile, keep a running max m and sum d:
+            m_new = max(m, max(tile))
+            d     = d * exp(m - m_new) + sum(exp(tile - m_new))
+        Then logsumexp = m + log(d), so BLOCK_SIZE need not cover VOCAB_SIZE.
+        This also handles large vocabs > 65536 like Gemma 256K in 1 kernel.
+        The label's logit x is then 1 scalar load, scaled / softcapped the same way.
+        out[row] = (loss, logsumexp) is written as 1 interleaved 8 byte store.
     """
     row_idx = tl.program_id(0)
-    logits_ptr    += row_idx * logits_row_stride.to(tl.int64)
-    loss_ptr      += row_idx
-    logsumexp_ptr += row_idx
-    labels_ptr    += row_idx
-
-    col_offsets = tl.arange(0, BLOCK_SIZE)
-    mask = col_offsets < VOCAB_SIZE
+    # Only pay for 64 bit pointer math if n_rows * stride overflows int32
+    if DO_INT64: logits_ptr += row_idx.to(tl.int64) * logits_row_stride
+    else:        logits_ptr += row_idx * logits_row_stride
+    out_ptr    += 2 * row_idx
+    labels_ptr += row_idx
 
     label_idx = tl.load(labels_ptr).to(tl.int32)
-    logits = tl.load(logits_ptr + col_offsets, mask = mask, other = -float("inf"))
 
-    # Go logit scaling for Cohere: t * x
-    if DO_LOGIT_SCALING: logits = LOGIT_SCALE * logits
-    # Do logit softcapping for Gemma 2: t * tanh(1/t * x)
-    if DO_SOFTCAPPING:   logits = SOFTCAP * triton_tanh(logits / SOFTCAP)
+    # Padded lanes load 0 and are masked out of the max with the smallest finite
+    # float32 instead of -inf, which some backends mishandle in exp / max.
+    m = -3.4028234663852886e38
+    d = 0.0
+    for col_start in range(0, VOCAB_SIZE, BLOCK_SIZE):
+        col_offsets = col_start + tl.arange(0, BLOCK_SIZE)
+        mask = col_offsets < VOCAB_SIZE
+        logits = tl.load(logits_ptr + col_offsets, mask = mask, other = 0.0).to(tl.float32)
 
-    logits = logits.to(tl.float32)
-    c = tl.max(logits, 0)
-    logsumexp = c + tl.log(tl.sum(tl.exp(logits - c), 0))
-
-    if label_idx != -100:
-        x = tl.load(logits_ptr + label_idx)
         # Go logit scaling for Cohere: t * x
-        if DO_LOGIT_SCALING: x = LOGIT_SCALE * x
+        if DO_LOGIT_SCALING: logits = LOGIT_SCALE * logits
         # Do logit softcapping for Gemma 2: t * tanh(1/t * x)
-        if DO_SOFTCAPPING:   x = SOFTCAP * triton_tanh(x / SOFTCAP)
-        loss = logsumexp - x.to(tl.float32)
-    else:
-        loss = 0.0
-    tl.store(logsumexp_ptr, logsumexp)
-    tl.store(loss_ptr, loss)
+        if DO_SOFTCAPPING:   logits = SOFTCAP * triton_tanh(logits / SOFTCAP)
+
+        m_new = tl.maximum(m, tl.max(tl.where(mask, logits, -3.4028234663852886e38), 0))
+        d = d * tl.exp(m - m_new) + tl.sum(tl.where(mask, tl.exp(logits - m_new), 0.0), 0)
+        m = m_new
+    pass
+    logsumexp = m + tl.log(d)
+
+    # Padding rows are predicated to 0 here, so the host never has to mask the losses
+    is_valid = label_idx != -100
+    x = tl.load(logits_ptr + label_idx, mask = is_valid, other = 0.0).to(tl.float32)
+    # Go logit scaling for Cohere: t * x
+    if DO_LOGIT_SCALING: x = LOGIT_SCALE * x
+    # Do logit softcapping for Gemma 2: t * tanh(1/t * x)
+    if DO_SOFTCAPPING:   x = SOFTCAP * triton_tanh(x / SOFTCAP)
+    loss = tl.where(is_valid, logsumexp - x, 0.0)
+    out_offsets = tl.arange(0, 2)
+    tl.store(out_ptr + out_offsets, tl.where(out_offsets == 0, loss, logsumexp))
 pass
 
 
@@ -96,285 +149,943 @@ pass
     "DO_LOGIT_SCALING": lambda args: args["DO_LOGIT_SCALING"],
 })
 @triton.jit
-def _chunked_cross_entropy_forward(
+def _cross_entropy_backward(
     logits_ptr, logits_row_stride,
-    loss_ptr,
-    logsumexp_ptr,
+    dloss_ptr,   dloss_row_stride,
+    logsumexp_ptr, logsumexp_row_stride,
     labels_ptr,
-    VOCAB_SIZE      : tl.constexpr,
-    N_CHUNKS        : tl.constexpr,
+    n_rows,
+    VOCAB_SIZE,
+    n_splits,
+    SPLIT_SIZE,
     BLOCK_SIZE      : tl.constexpr,
     DO_SOFTCAPPING  : tl.constexpr,
     SOFTCAP         : tl.constexpr,
     DO_LOGIT_SCALING: tl.constexpr,
     LOGIT_SCALE     : tl.constexpr,
+    DO_INT64        : tl.constexpr,
 ):
     """
-        256K vocab divided in 4 chunks
+        CE_i = -y log(P) = y * (log[sum(exp(x))] - x)
+        dC/dx = d/dx (y * log[sum(exp(x))] - x * y)
 
-        |-65536-| |-65536-| |-65536-| |-65536-|
-        |-------| |-------| |-------| |-------|
-        |-------| |-------| |-------| |-------|
+        From https://en.wikipedia.org/wiki/LogSumExp
+        d/dx logsumexp = exp(x) / sum(exp(x)) = softmax(x)
 
-        If y == 0: CE_i = 0
-        If y == 1: CE_i = logsumexp - x
+        dC/dx = y * exp(x) / sum(exp(x)) - d/dx (x * y)
+        dC/dx = y * exp[ log[exp(x) / sum(exp(x))] ] using x = exp(log(x)) trick
+        dC/dx = y * exp[x - logsumexp] - d/dx (x * y)
 
-        Notice we can do logsumexp for each chunk and then
-        logsumexp[chunk_sum(logsumexp)] == logsumexp
+        If y == 0: dC/dx = 0
+        If y == 1 and x == label: dC/dlabel = exp[x - logsumexp] - 1
+        If y == 1 and x != label: dC/dx     = exp[x - logsumexp]
+    """
+    # Persistent programs stride over (row, split) work items, where each row is
+    # cut into n_splits column ranges of SPLIT_SIZE. Big batches use 1 split per
+    # row, and small batches use more so every SM still gets work. Each item's
+    # dloss, logsumexp and label are only loaded once.
+    for item_idx in range(tl.program_id(0), n_rows * n_splits, tl.num_programs(0)):
+        row_idx   = item_idx // n_splits
+        col_begin = (item_idx % n_splits) * SPLIT_SIZE
+        col_end   = tl.minimum(col_begin + SPLIT_SIZE, VOCAB_SIZE)
+        if DO_INT64: row_logits_ptr = logits_ptr + row_idx.to(tl.int64) * logits_row_stride
+        else:        row_logits_ptr = logits_ptr + row_idx * logits_row_stride
+        label_idx = tl.load(labels_ptr + row_idx).to(tl.int32)
 
-        chunk_sum = log[chunk_sum(logsumexp)]
-                  = log[exp(logsumexp(a)) + ... + exp(logsumexp(z))]
-                  = log[exp(log[sum(exp(a))]) + ... + exp(log[sum(exp(z))])]
-                  = log[sum(exp(a)) + ... + sum(exp(z))]
-                  = logsumexp(x)
+        if label_idx == -100:
+            # If y == 0: dC/dx = 0, so padding rows just get zeros written.
+            # This skips the logits loads and exps, which helps heavily padded batches.
+            for col_start in range(col_begin, col_end, BLOCK_SIZE):
+                col_offsets = col_start + tl.arange(0, BLOCK_SIZE)
+                mask = col_offsets < col_end
+                zeros = tl.zeros((BLOCK_SIZE,), dtype = logits_ptr.dtype.element_ty)
+                tl.store(row_logits_ptr + col_offsets, zeros, mask = mask)
+            pass
+        else:
+            dloss     = tl.load(dloss_ptr + row_idx * dloss_row_stride)
+            logsumexp = tl.load(logsumexp_ptr + row_idx * logsumexp_row_stride)
 
-        This means we can perform a logsumexp for each chunk, then do a
-        final logsumexp reduction!
+            # Fold dloss and the Cohere scale into 1 per row constant, so each element
+            # is exp(x - logsumexp) * scale, then 1 subtract for the label.
+            # This only saves a multiply per element when DO_LOGIT_SCALING is set.
+            # exp(x) * exp(-logsumexp) would save the subtract, but overflows for x > 88.
+            scale = dloss
+            if DO_LOGIT_SCALING:
+                # d/dx [s * x] = s
+                scale = scale * LOGIT_SCALE
+            pass
+
+            for col_start in range(col_begin, col_end, BLOCK_SIZE):
+                col_offsets = col_start + tl.arange(0, BLOCK_SIZE)
+                mask = col_offsets < col_end
+                # Accumulate in float32, even if logits are bfloat16 / float16
+                x = tl.load(row_logits_ptr + col_offsets, mask = mask, other = 0.0).to(tl.float32)
+
+                # Do logit scaling for Cohere
+                if DO_LOGIT_SCALING:
+                    # d/dx [s * x] = s
+                    x = x * LOGIT_SCALE
+                pass
+
+                # Do logit softcapping for Gemma 2: t * tanh(1/t * x)
+                if DO_SOFTCAPPING:
+                    # d/dx [t * tanh(1/t * x)] = 1 - tanh^2(1/t * x)
+                    partial = triton_tanh(x / SOFTCAP)
+                    x = SOFTCAP * partial
+                pass
+
+                y = tl.exp(x - logsumexp) * scale
+                y = tl.where(
+                    col_offsets == label_idx,
+                    y - scale, # (exp(x - logsumexp) - 1) * scale
+                    y,         #  exp(x - logsumexp)      * scale
+                )
 
-        Ie do: logsumexp(chunked_logsumexp) - x
+                if DO_SOFTCAPPING:
+                    # d/dx [t * tanh(1/t * x)] = 1 - tanh^2(1/t * x)
+                    y = y * (1.0 - partial*partial)
+                pass
+
+                # Write back in the logits' own dtype, so bfloat16 halves the bytes stored.
+                tl.store(row_logits_ptr + col_offsets, y.to(logits_ptr.dtype.element_ty), mask = mask)
+            pass
+        pass
+    pass
+pass
+
+
+@triton.jit
+def _cross_entropy_partial_sums(
+    loss_ptr, loss_row_stride,
+    labels_ptr,
+    partials_ptr,
+    n_rows,
+    BLOCK_SIZE : tl.constexpr,
+):
     """
-    row_idx   = tl.program_id(0)
-    chunk_idx = tl.program_id(1)
-    logits_ptr    += row_idx * logits_row_stride.to(tl.int64)
-    loss_ptr      += row_idx
-    logsumexp_ptr += row_idx * N_CHUNKS + chunk_idx
-    labels_ptr    += row_idx
+        partials[pid] = (sum(CE_i), count(labels != -100)) over this program's tiles.
+        Programs stride over BLOCK_SIZE tiles of the rows, so long or packed
+        batches spread the scan over every SM before the finalize combines them.
+    """
+    loss_sum = 0.0
+    n_items  = 0
+    for row_start in range(tl.program_id(0) * BLOCK_SIZE, n_rows, tl.num_programs(0) * BLOCK_SIZE):
+        row_offsets = row_start + tl.arange(0, BLOCK_SIZE)
+        mask = row_offsets < n_rows
+        losses = tl.load(loss_ptr   + row_offsets * loss_row_stride, mask = mask, other = 0.0)
+        labels = tl.load(labels_ptr + row_offsets, mask = mask, other = -100)
+        loss_sum += tl.sum(losses, 0)
+        n_items  += tl.sum((labels != -100).to(tl.int32), 0)
+    pass
+    out_offsets = tl.arange(0, 2)
+    tl.store(
+        partials_ptr + 2 * tl.program_id(0) + out_offsets,
+        tl.where(out_offsets == 0, loss_sum, n_items.to(tl.float32)),
+    )
+pass
 
-    col_offsets = chunk_idx*BLOCK_SIZE + tl.arange(0, BLOCK_SIZE)
-    mask = col_offsets < VOCAB_SIZE
 
-    label_idx = tl.load(labels_ptr).to(tl.int32)
-    logits = tl.load(logits_ptr + col_offsets, mask = mask, other = -float("inf"))
+@triton.jit
+def _cross_entropy_finalize(
+    loss_ptr, loss_row_stride,
+    labels_ptr,
+    out_ptr,
+    n_items_ptr,
+    n_items_in_ptr,
+    n_rows,
+    BLOCK_SIZE    : tl.constexpr,
+    FROM_PARTIALS : tl.constexpr,
+    HAS_N_ITEMS   : tl.constexpr,
+):
+    """
+        loss = sum(CE_i) / count(labels != -100)
+        1 program loops over all rows, accumulating both sums at once.
+        This skips the labels != -100 bool tensor and 2 extra reductions.
+        If FROM_PARTIALS, the rows are instead the (loss sum, count) pairs
+        from _cross_entropy_partial_sums, and labels_ptr is unused.
+        If HAS_N_ITEMS, a positive n_items_in replaces the count, so a CUDA
+        graph can switch between both denominators without recapturing.
+    """
+    loss_sum = 0.0
+    n_items  = 0
+    for row_start in range(0, n_rows, BLOCK_SIZE):
+        row_offsets = row_start + tl.arange(0, BLOCK_SIZE)
+        mask = row_offsets < n_rows
+        losses = tl.load(loss_ptr + row_offsets * loss_row_stride, mask = mask, other = 0.0)
+        loss_sum += tl.sum(losses, 0)
+        if FROM_PARTIALS:
+            counts = tl.load(loss_ptr + row_offsets * loss_row_stride + 1, mask = mask, other = 0.0)
+            n_items += tl.sum(counts.to(tl.int32), 0)
+        else:
+            labels = tl.load(labels_ptr + row_offsets, mask = mask, other = -100)
+            n_items += tl.sum((labels != -100).to(tl.int32), 0)
+        pass
+    pass
+    n_items = n_items.to(tl.float32)
+    if HAS_N_ITEMS:
+        n_items_in = tl.load(n_items_in_ptr)
+        n_items = tl.where(n_items_in > 0, n_items_in, n_items)
+    pass
+    tl.store(n_items_ptr, n_items)
+    tl.store(out_ptr, loss_sum / n_items)
+pass
 
-    # Go logit scaling for Cohere: t * x
-    if DO_LOGIT_SCALING: logits = LOGIT_SCALE * logits
-    # Do logit softcapping for Gemma 2: t * tanh(1/t * x)
-    if DO_SOFTCAPPING:   logits = SOFTCAP * triton_tanh(logits / SOFTCAP)
-
-    logits = logits.to(tl.float32)
-    c = tl.max(logits, 0)
-    logsumexp = c + tl.log(tl.sum(tl.exp(logits - c), 0))
-
-    if chunk_idx == 0:
-        # logsumexp(chunked_logsumexp) - x
-        # Do the -x separately
-        if label_idx != -100:
-            x = tl.load(logits_ptr + label_idx).to(tl.float32)
-            # Go logit scaling for Cohere: t * x
-            if DO_LOGIT_SCALING: x = LOGIT_SCALE * x
-            # Do logit softcapping for Gemma 2: t * tanh(1/t * x)
-            if DO_SOFTCAPPING:   x = SOFTCAP * triton_tanh(x / SOFTCAP)
-            loss = -1.0 * x.to(tl.float32)
+
+@triton.jit
+def _count_valid_labels(
+    labels_ptr, labels_row_stride,
+    n_items_ptr,
+    n_cols,
+    BLOCK_SIZE : tl.constexpr,
+):
+    """
+        n_items += count(labels != -100) for 1 BLOCK_SIZE tile of 1 row.
+        The comparison is done in registers, so no bool tensor is written.
+    """
+    row_idx = tl.program_id(0)
+    col_offsets = tl.program_id(1) * BLOCK_SIZE + tl.arange(0, BLOCK_SIZE)
+    mask = col_offsets < n_cols
+    labels = tl.load(labels_ptr + row_idx * labels_row_stride + col_offsets, mask = mask, other = -100)
+    tl.atomic_add(n_items_ptr, tl.sum((labels != -100).to(tl.int32), 0))
+pass
+
+
+NUM_SMS = torch.cuda.get_device_properties(0).multi_processor_count
+# Resident warps per SM bound how many persistent programs fit in 1 wave.
+# num_warps counts 64 wide wavefronts on AMD.
+MAX_WARPS_PER_SM = getattr(
+    torch.cuda.get_device_properties(0), "max_threads_per_multi_processor", 2048,
+) // (64 if IS_HIP else 32)
+# 1 program finalizes up to 64K rows. Longer or packed batches get partial sums first.
+FINALIZE_MAX_ROWS = 65536
+
+def _cross_entropy_forward_launch(logits, labels, logit_softcapping = 0, logit_scaling = 0):
+    """
+    Runs the online softmax forward over (n_rows, vocab_size) logits.
+    Returns the per row losses, logsumexp and the launch config the backward should use.
+    """
+    n_rows, vocab_size = logits.shape
+
+    # Interleaved (loss, logsumexp) pairs, so each row does 1 store
+    out = torch.empty((n_rows, 2), dtype = torch.float32, device = "cuda:0")
+
+    # Online softmax loops over the row, so small vocabs like Llama, Mistral
+    # and large vocabs > 65336 like Gemma 256K all use 1 kernel and 1 program per row.
+    # BLOCK_SIZE and num_warps are autotuned per vocab size.
+    _cross_entropy_forward[(n_rows,)](
+        logits, logits.stride(0),
+        out,
+        labels,
+        VOCAB_SIZE       = vocab_size,
+        VOCAB_CLASS      = _vocab_class(vocab_size),
+        DO_SOFTCAPPING   = (logit_softcapping != 0),
+        SOFTCAP          = logit_softcapping,
+        DO_LOGIT_SCALING = (logit_scaling != 0),
+        LOGIT_SCALE      = logit_scaling,
+        DO_INT64         = (n_rows * logits.stride(0) >= 2**31),
+    )
+
+    # The backward writes in place over the logits, so it can't be benchmarked
+    # without copying them. It also streams each row once, so just reuse the
+    # BLOCK_SIZE, num_warps and num_stages the forward tuned for this vocab.
+    config = _cross_entropy_forward.best_config
+    launch_config = dict(
+        BLOCK_SIZE = config.kwargs["BLOCK_SIZE"],
+        num_warps  = config.num_warps,
+        num_stages = config.num_stages,
+    )
+    return out[:, 0], out[:, 1], launch_config
+pass
+
+
+def _cross_entropy_backward_launch(
+    logits, dlosses, logsumexp, labels, launch_config,
+    logit_softcapping = 0, logit_scaling = 0,
+):
+    """
+    Overwrites logits in place with dC/dlogits.
+    """
+    n_rows, vocab_size = logits.shape
+    BLOCK_SIZE = launch_config["BLOCK_SIZE"]
+
+    # As many programs as fit on the GPU at once for the forward's num_warps
+    max_programs = NUM_SMS * max(1, MAX_WARPS_PER_SM // launch_config["num_warps"])
+    # Too few rows to fill the GPU, so also split each row into BLOCK_SIZE multiples
+    n_tiles  = triton.cdiv(vocab_size, BLOCK_SIZE)
+    n_splits = min(triton.cdiv(max_programs, max(n_rows, 1)), n_tiles)
+    SPLIT_SIZE = triton.cdiv(n_tiles, n_splits) * BLOCK_SIZE
+    n_splits   = triton.cdiv(vocab_size, SPLIT_SIZE)
+    n_programs = min(n_rows * n_splits, max_programs)
+
+    _cross_entropy_backward[(n_programs,)](
+        logits,   logits.stride(0),
+        dlosses, dlosses.stride(0),
+        logsumexp, logsumexp.stride(0),
+        labels,
+        n_rows,
+        VOCAB_SIZE       = vocab_size,
+        n_splits         = n_splits,
+        SPLIT_SIZE       = SPLIT_SIZE,
+        DO_SOFTCAPPING   = (logit_softcapping != 0),
+        SOFTCAP          = logit_softcapping,
+        DO_LOGIT_SCALING = (logit_scaling != 0),
+        LOGIT_SCALE      = logit_scaling,
+        DO_INT64         = (n_rows * logits.stride(0) >= 2**31),
+        **launch_config,
+    )
+    return logits
+pass
+
+
+def _cross_entropy_finalize_launch(losses, labels, n_items_in = None):
+    """
+    Returns sum(losses) / n_items and n_items, which is count(labels != -100)
+    unless the float32 scalar n_items_in holds a positive override.
+    """
+    n_rows = losses.shape[0]
+    loss    = torch.empty((), dtype = torch.float32, device = "cuda:0")
+    n_items = torch.empty((), dtype = torch.float32, device = "cuda:0")
+
+    if n_rows <= FINALIZE_MAX_ROWS:
+        rows, rows_stride, n_finalize_rows, FROM_PARTIALS = losses, losses.stride(0), n_rows, False
+    else:
+        # Each SM sums a strided slice of the rows, then 1 program combines them
+        BLOCK_SIZE = 1024
+        n_programs = min(NUM_SMS, triton.cdiv(n_rows, BLOCK_SIZE))
+        partials = torch.empty((n_programs, 2), dtype = torch.float32, device = "cuda:0")
+        _cross_entropy_partial_sums[(n_programs,)](
+            losses, losses.stride(0),
+            labels,
+            partials,
+            n_rows,
+            BLOCK_SIZE = BLOCK_SIZE,
+            num_warps  = 4,
+            num_stages = 1 if IS_HIP else 3,
+        )
+        rows, rows_stride, n_finalize_rows, FROM_PARTIALS = partials, partials.stride(0), n_programs, True
+    pass
+
+    _cross_entropy_finalize[(1,)](
+        rows, rows_stride,
+        labels,
+        loss,
+        n_items,
+        n_items if n_items_in is None else n_items_in,
+        n_finalize_rows,
+        BLOCK_SIZE    = 4096,
+        FROM_PARTIALS = FROM_PARTIALS,
+        HAS_N_ITEMS   = n_items_in is not None,
+        num_warps     = 8,
+        num_stages    = 1 if IS_HIP else 3,
+    )
+    return loss, n_items
+pass
+
+
+class Fast_CrossEntropyLoss(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, logits, labels, logit_softcapping = 0, logit_scaling = 0):
+        losses, logsumexp, launch_config = _cross_entropy_forward_launch(
+            logits, labels, logit_softcapping, logit_scaling,
+        )
+        ctx.save_for_backward(logits, logsumexp, labels)
+        ctx.launch_config     = launch_config
+        ctx.logit_softcapping = logit_softcapping
+        ctx.logit_scaling     = logit_scaling
+        return losses
+    pass
+
+    @staticmethod
+    def backward(ctx, dlosses):
+        logits, logsumexp, labels = ctx.saved_tensors
+        _cross_entropy_backward_launch(
+            logits, dlosses, logsumexp, labels, ctx.launch_config,
+            ctx.logit_softcapping, ctx.logit_scaling,
+        )
+        return logits, None, None, None,
+    pass
+pass
+
+
+class Fast_CrossEntropyLossMean(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, losses, labels):
+        loss, n_items = _cross_entropy_finalize_launch(losses, labels)
+        ctx.save_for_backward(n_items)
+        ctx.n_rows = losses.shape[0]
+        return loss
+    pass
+
+    @staticmethod
+    def backward(ctx, dloss):
+        n_items, = ctx.saved_tensors
+        # Stride 0 view, so the backward kernel reads the same dloss for every row
+        dlosses = (dloss / n_items).expand(ctx.n_rows)
+        return dlosses, None,
+    pass
+pass
+
+
+@torch._disable_dynamo
+def fast_cross_entropy_loss(
+    logits,
+    labels,
+    logit_softcapping = 0,
+    logit_scaling = 0,
+    n_items = None,
+):
+    """
+    Arguments:
+        logits: (batch, seq_len, vocab_size)
+        labels: (batch, seq_len,)
+    Returns:
+        losses: float
+    """
+    batch, seq_len, d = logits.shape
+    assert(labels.shape == (batch, seq_len))
+
+    loss = Fast_CrossEntropyLoss.apply(
+        logits.view(batch*seq_len, d),
+        labels.view(-1),
+        logit_softcapping,
+        logit_scaling,
+    )
+    if n_items is None:
+        # Fused sum(loss) / count(labels != -100) in 1 kernel
+        return Fast_CrossEntropyLossMean.apply(loss, labels.view(-1))
+    return loss.sum() / n_items
+pass
+
+
+def fast_count_valid_labels(labels):
+    """
+    Same as torch.count_nonzero(labels != -100), but in 1 kernel
+    without materializing the labels != -100 bool tensor.
+    Arguments:
+        labels: (..., seq_len) can be a non contiguous slice like labels[..., 1:]
+    Returns:
+        n_items: int32 scalar tensor
+    """
+    if not labels.is_cuda: return torch.count_nonzero(labels != -100)
+    labels = labels.reshape(-1, labels.shape[-1])
+    if labels.stride(-1) != 1: labels = labels.contiguous()
+    n_rows, n_cols = labels.shape
+
+    n_items = torch.zeros((), dtype = torch.int32, device = labels.device)
+    BLOCK_SIZE = 1024
+    _count_valid_labels[(n_rows, triton.cdiv(n_cols, BLOCK_SIZE),)](
+        labels, labels.stride(0),
+        n_items,
+        n_cols,
+        BLOCK_SIZE = BLOCK_SIZE,
+        num_warps  = 4,
+    )
+    return n_items
+pass
+
+
+class Fast_CUDAGraphedLinear(torch.autograd.Function):
+    """
+    logits = hidden @ W.T, written into a CUDAGraphedCE's static logits buffer.
+    """
+    @staticmethod
+    def forward(ctx, hidden, weight, graph):
+        logits = graph["logits"]
+        torch.matmul(hidden.reshape(-1, hidden.shape[-1]), weight.t(), out = logits)
+        ctx.save_for_backward(hidden, weight)
+        return logits.view(*hidden.shape[:-1], weight.shape[0])
+    pass
+
+    @staticmethod
+    def backward(ctx, dlogits):
+        hidden, weight = ctx.saved_tensors
+        dlogits = dlogits.reshape(-1, weight.shape[0])
+        dhidden = (dlogits @ weight).view(hidden.shape)
+        dweight = dlogits.t() @ hidden.reshape(-1, hidden.shape[-1]) if ctx.needs_input_grad[1] else None
+        return dhidden, dweight, None,
+    pass
+pass
+
+
+class Fast_CUDAGraphedCrossEntropyLoss(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, logits, labels, n_items, graph, logit_softcapping = 0, logit_scaling = 0):
+        graph["labels"].view(labels.shape).copy_(labels)
+        graph["n_items_in"].fill_(0 if n_items is None else n_items)
+
+        if "forward" in graph:
+            graph["forward"].replay()
+            loss, n_items, logsumexp, launch_config = graph["forward_outputs"]
         else:
-            loss = 0.0
-        tl.store(loss_ptr, loss)
+            # The first call runs eagerly, which also compiles and autotunes the kernels.
+            # Capturing afterwards doesn't run anything, so later calls just replay.
+            loss, n_items, logsumexp, launch_config = _cuda_graphed_ce_forward(
+                graph, logit_softcapping, logit_scaling,
+            )
+            graph["forward"] = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(graph["forward"]):
+                graph["forward_outputs"] = _cuda_graphed_ce_forward(
+                    graph, logit_softcapping, logit_scaling,
+                )
+            pass
+        pass
+        ctx.graph             = graph
+        ctx.logits_shape      = logits.shape
+        ctx.eager_outputs     = (n_items, logsumexp, launch_config)
+        ctx.logit_softcapping = logit_softcapping
+        ctx.logit_scaling     = logit_scaling
+        # The static loss is overwritten by the next replay
+        return loss.clone()
+    pass
+
+    @staticmethod
+    def backward(ctx, dloss):
+        graph = ctx.graph
+        graph["dloss"].copy_(dloss)
+
+        if "backward" in graph:
+            graph["backward"].replay()
+        else:
+            _cuda_graphed_ce_backward(graph, *ctx.eager_outputs, ctx.logit_softcapping, ctx.logit_scaling)
+            # Replays read the forward graph's static n_items and logsumexp
+            _, n_items, logsumexp, launch_config = graph["forward_outputs"]
+            graph["backward"] = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(graph["backward"]):
+                _cuda_graphed_ce_backward(
+                    graph, n_items, logsumexp, launch_config, ctx.logit_softcapping, ctx.logit_scaling,
+                )
+            pass
+        pass
+        # graph["logits"] now holds dC/dlogits
+        return graph["logits"].view(ctx.logits_shape), None, None, None, None, None,
     pass
-    tl.store(logsumexp_ptr, logsumexp)
 pass
 
 
+def _cuda_graphed_ce_forward(graph, logit_softcapping, logit_scaling):
+    # 2 launches, or 3 with the partial sums for > 64K rows
+    losses, logsumexp, launch_config = _cross_entropy_forward_launch(
+        graph["logits"], graph["labels"], logit_softcapping, logit_scaling,
+    )
+    loss, n_items = _cross_entropy_finalize_launch(losses, graph["labels"], graph["n_items_in"])
+    return loss, n_items, logsumexp, launch_config
+pass
+
+
+def _cuda_graphed_ce_backward(graph, n_items, logsumexp, launch_config, logit_softcapping, logit_scaling):
+    # Stride 0 view, so the backward kernel reads the same dloss for every row
+    dlosses = (graph["dloss"] / n_items).expand(graph["logits"].shape[0])
+    _cross_entropy_backward_launch(
+        graph["logits"], dlosses, logsumexp, graph["labels"], launch_config,
+        logit_softcapping, logit_scaling,
+    )
+pass
+
+
+class CUDAGraphedCE:
+    """
+    fast_cross_entropy_loss, but the forward and backward kernels are captured
+    into CUDA graphs and replayed, so each step skips the launch overheads.
+    A graph needs fixed addresses, so the lm_head writes its logits straight into
+    a static buffer per (batch*seq_len, vocab_size, dtype), without any copies:
+        logits = ce.linear(hidden, lm_head.weight)
+        loss   = ce(logits, labels)
+    Both are autograd aware. Logits from anywhere else, or new shapes once
+    max_graphs buffers exist, fall back to the eager kernels.
+    The buffer is reused, so logits are only valid until the next ce.linear call.
+    Arguments:
+        max_graphs: maximum number of captured shapes, each holding its own logits buffer
+    """
+    def __init__(
+        self,
+        logit_softcapping = 0,
+        logit_scaling = 0,
+        max_graphs = 1,
+    ):
+        self.logit_softcapping = logit_softcapping
+        self.logit_scaling     = logit_scaling
+        self.max_graphs        = max_graphs
+        self.graphs            = {}
+    pass
+
+    @torch._disable_dynamo
+    def linear(self, hidden, weight):
+        """
+        Arguments:
+            hidden: (batch, seq_len, hidden_size)
+            weight: (vocab_size, hidden_size) ie lm_head.weight
+        Returns:
+            logits: (batch, seq_len, vocab_size)
+        """
+        n_rows = hidden.numel() // hidden.shape[-1]
+        key = (n_rows, weight.shape[0], weight.dtype,)
+        if key not in self.graphs:
+            if len(self.graphs) >= self.max_graphs: return hidden @ weight.t()
+            self.graphs[key] = dict(
+                logits     = torch.empty((n_rows, weight.shape[0]), dtype = weight.dtype, device = "cuda:0"),
+                labels     = torch.empty(n_rows, dtype = torch.int64,   device = "cuda:0"),
+                # 0 means divide by count(labels != -100)
+                n_items_in = torch.empty((),     dtype = torch.float32, device = "cuda:0"),
+                dloss      = torch.empty((),     dtype = torch.float32, device = "cuda:0"),
+            )
+        pass
+        return Fast_CUDAGraphedLinear.apply(hidden.to(weight.dtype), weight, self.graphs[key])
+    pass
+
+    @torch._disable_dynamo
+    def __call__(self, logits, labels, n_items = None):
+        """
+        Arguments:
+            logits: (batch, seq_len, vocab_size)
+            labels: (batch, seq_len,)
+        Returns:
+            losses: float
+        """
+        n_rows = logits.numel() // logits.shape[-1]
+        graph = self.graphs.get((n_rows, logits.shape[-1], logits.dtype,))
+        if graph is None or logits.data_ptr() != graph["logits"].data_ptr():
+            return fast_cross_entropy_loss(
+                logits = logits,
+                labels = labels,
+                logit_softcapping = self.logit_softcapping,
+                logit_scaling     = self.logit_scaling,
+                n_items           = n_items,
+            )
+        pass
+        return Fast_CUDAGraphedCrossEntropyLoss.apply(
+            logits, labels, n_items, graph, self.logit_softcapping, self.logit_scaling,
+        )
+    pass
+pass
+
+
+# AMD's pipeliner prefers 2 stages, so it only gets 4 warps.
+# NVIDIA also tries 8 warps and deeper pipelines.
+# Every program streams all of W, so W is re-read n_rows / BLOCK_N times.
+# tl.dot needs BLOCK_N >= 16, but larger row tiles cut that traffic a lot.
+# The float32 logits tile is BLOCK_N * BLOCK_V, so cap it to fit in registers.
+def _linear_cross_entropy_configs():
+    num_warps  = (4,) if IS_HIP else (4, 8,)
+    num_stages = (2,) if IS_HIP else (2, 3, 4,)
+    return [
+        triton.Config(
+            {"BLOCK_N" : BLOCK_N, "BLOCK_V" : BLOCK_V, "BLOCK_D" : BLOCK_D},
+            num_warps = w, num_stages = s,
+        )
+        for BLOCK_N in (16, 64, 128,)
+        for BLOCK_V in (64, 128, 256,)
+        for BLOCK_D in (32, 64,)
+        for w in num_warps
+        for s in num_stages
+        if BLOCK_N * BLOCK_V <= 16384
+    ]
+pass
+
+
+def _rows_class(n_rows):
+    # The best BLOCK_N depends on the batch, so tune once per row count class:
+    # 1 row tile, a few row tiles, under about 1 wave of tiles, then large batches.
+    if   n_rows <=   16: return 0
+    elif n_rows <=   64: return 1
+    elif n_rows <= 4096: return 2
+    return 3
+pass
+
+
+def _linear_cross_entropy_prune(configs, named_args, **kwargs):
+    # Older Triton only passes the positional arguments, so use n_rows.
+    # Streaming W dominates, so small batches just take the biggest row tile
+    # they reach, and larger ones skip 16 row tiles which re-read W 4x more.
+    # 64 wide vocab tiles also underuse tl.dot once BLOCK_N >= 64.
+    ROWS_CLASS = _rows_class(named_args["n_rows"])
+    min_block_n, max_block_n = ((16, 16,), (64, 64,), (64, 128,), (64, 128,),)[ROWS_CLASS]
+    return [
+        config for config in configs
+        if min_block_n <= config.kwargs["BLOCK_N"] <= max_block_n
+        and (config.kwargs["BLOCK_N"] == 16 or config.kwargs["BLOCK_V"] >= 128)
+    ]
+pass
+
+
+@triton.autotune(
+    configs = _linear_cross_entropy_configs(),
+    key = ["HIDDEN_SIZE", "VOCAB_CLASS", "ROWS_CLASS", "DO_FP8"],
+    prune_configs_by = {"early_config_prune" : _linear_cross_entropy_prune},
+)
 @triton.heuristics({
     "DO_SOFTCAPPING":   lambda args: args["DO_SOFTCAPPING"  ],
     "DO_LOGIT_SCALING": lambda args: args["DO_LOGIT_SCALING"],
 })
-@triton.jit
-def _cross_entropy_backward(
-    logits_ptr, logits_row_stride,
-    dloss_ptr,   dloss_row_stride,
-    logsumexp_ptr,
+@triton.jit(do_not_specialize = ["VOCAB_CLASS", "ROWS_CLASS"])
+def _linear_cross_entropy_forward(
+    hidden_ptr, hidden_row_stride,
+    weight_ptr, weight_row_stride,
+    hidden_scale_ptr, hidden_scale_stride,
+    weight_scale_ptr, weight_scale_stride,
+    loss_ptr,
     labels_ptr,
-    VOCAB_SIZE      : tl.constexpr,
-    BLOCK_SIZE      : tl.constexpr,
+    n_rows,
+    HIDDEN_SIZE     : tl.constexpr,
+    VOCAB_SIZE,
+    VOCAB_CLASS,
+    ROWS_CLASS,
+    BLOCK_N         : tl.constexpr,
+    BLOCK_V         : tl.constexpr,
+    BLOCK_D         : tl.constexpr,
     DO_SOFTCAPPING  : tl.constexpr,
     SOFTCAP         : tl.constexpr,
     DO_LOGIT_SCALING: tl.constexpr,
     LOGIT_SCALE     : tl.constexpr,
+    DO_INT64        : tl.constexpr,
+    DO_FP8          : tl.constexpr,
 ):
     """
-        CE_i = -y log(P) = y * (log[sum(exp(x))] - x)
-        dC/dx = d/dx (y * log[sum(exp(x))] - x * y)
+        Same online softmax as _cross_entropy_forward, except the logits
+        x = hidden @ W.T are computed tile by tile and never written out.
+        Each program owns BLOCK_N rows so the matmul can use tl.dot.
+        For each BLOCK_V tile of the vocab:
+            x  = sum over BLOCK_D chunks of hidden[:, d] @ W[v, d].T
+            m_new = max(m, max(x))
+            d     = d * exp(m - m_new) + sum(exp(x - m_new))
+        logsumexp = m + log(d) and CE_i = logsumexp - x[label].
 
-        From https://en.wikipedia.org/wiki/LogSumExp
-        d/dx logsumexp = exp(x) / sum(exp(x)) = softmax(x)
+        If DO_FP8, hidden and W are float8 e4m3 and tl.dot runs on the FP8 tensor
+        cores. The float32 tile is dequantized with the per row scales
+            x = hidden_scale[rows, None] * W_scale[None, cols] * (hidden_q @ W_q.T)
+        before the softmax, so the label's logit is dequantized the same way.
+    """
+    row_offsets = tl.program_id(0) * BLOCK_N + tl.arange(0, BLOCK_N)
+    row_mask    = row_offsets < n_rows
+    if DO_INT64: hidden_ptr += row_offsets.to(tl.int64)[:, None] * hidden_row_stride
+    else:        hidden_ptr += row_offsets[:, None] * hidden_row_stride
+    label_idx   = tl.load(labels_ptr + row_offsets, mask = row_mask, other = -100).to(tl.int32)
+    if DO_FP8:
+        h_scale = tl.load(hidden_scale_ptr + row_offsets * hidden_scale_stride, mask = row_mask, other = 0.0)
+    pass
 
-        dC/dx = y * exp(x) / sum(exp(x)) - d/dx (x * y)
-        dC/dx = y * exp[ log[exp(x) / sum(exp(x))] ] using x = exp(log(x)) trick
-        dC/dx = y * exp[x - logsumexp] - d/dx (x * y)
+    m = tl.full((BLOCK_N,), -3.4028234663852886e38, dtype = tl.float32)
+    d = tl.zeros((BLOCK_N,), dtype = tl.float32)
+    x = tl.zeros((BLOCK_N,), dtype = tl.float32)
+    for col_start in range(0, VOCAB_SIZE, BLOCK_V):
+        col_offsets = col_start + tl.arange(0, BLOCK_V)
+        col_mask    = col_offsets < VOCAB_SIZE
+        if DO_INT64: w_ptr = weight_ptr + col_offsets.to(tl.int64)[None, :] * weight_row_stride
+        else:        w_ptr = weight_ptr + col_offsets[None, :] * weight_row_stride
 
-        If y == 0: dC/dx = 0
-        If y == 1 and x == label: dC/dlabel = exp[x - logsumexp] - 1
-        If y == 1 and x != label: dC/dx     = exp[x - logsumexp]
-    """
-    row_idx   = tl.program_id(0)
-    block_idx = tl.program_id(1)
+        # logits tile = hidden[rows, :] @ W[cols, :].T in float32
+        logits = tl.zeros((BLOCK_N, BLOCK_V), dtype = tl.float32)
+        for d_start in range(0, HIDDEN_SIZE, BLOCK_D):
+            d_offsets = d_start + tl.arange(0, BLOCK_D)
+            d_mask    = d_offsets < HIDDEN_SIZE
+            h = tl.load(hidden_ptr + d_offsets[None, :], mask = row_mask[:, None] & d_mask[None, :], other = 0.0)
+            w = tl.load(w_ptr      + d_offsets[:, None], mask = d_mask[:, None] & col_mask[None, :], other = 0.0)
+            logits = tl.dot(h, w, logits)
+        pass
 
-    logits_ptr += row_idx * logits_row_stride.to(tl.int64)
-    dloss_ptr  += row_idx *  dloss_row_stride
-    col_offsets = block_idx*BLOCK_SIZE + tl.arange(0, BLOCK_SIZE)
-    mask = col_offsets < VOCAB_SIZE
-    label_idx = tl.load(labels_ptr + row_idx).to(tl.int32)
+        if DO_FP8:
+            w_scale = tl.load(weight_scale_ptr + col_offsets * weight_scale_stride, mask = col_mask, other = 0.0)
+            logits  = logits * h_scale[:, None] * w_scale[None, :]
+        pass
 
-    if label_idx != -100:
-        dloss = tl.load(dloss_ptr)
-    else:
-        dloss = 0.0
+        # Go logit scaling for Cohere: t * x
+        if DO_LOGIT_SCALING: logits = LOGIT_SCALE * logits
+        # Do logit softcapping for Gemma 2: t * tanh(1/t * x)
+        if DO_SOFTCAPPING:   logits = SOFTCAP * triton_tanh(logits / SOFTCAP)
 
-    x = tl.load(logits_ptr + col_offsets, mask = mask, other = -float("inf"))
+        m_new = tl.maximum(m, tl.max(tl.where(col_mask[None, :], logits, -3.4028234663852886e38), 1))
+        d = d * tl.exp(m - m_new) + tl.sum(tl.where(col_mask[None, :], tl.exp(logits - m_new[:, None]), 0.0), 1)
+        m = m_new
 
-    # Do logit scaling for Cohere
-    if DO_LOGIT_SCALING:
-        # d/dx [s * x] = s
-        x = x * LOGIT_SCALE
+        x += tl.sum(tl.where(col_offsets[None, :] == label_idx[:, None], logits, 0.0), 1)
     pass
+    logsumexp = m + tl.log(d)
 
-    # Do logit softcapping for Gemma 2: t * tanh(1/t * x)
-    if DO_SOFTCAPPING:
-        # d/dx [t * tanh(1/t * x)] = 1 - tanh^2(1/t * x)
-        partial = triton_tanh(x / SOFTCAP)
-        x = SOFTCAP * partial
-    pass
+    loss = tl.where(label_idx != -100, logsumexp - x, 0.0)
+    tl.store(loss_ptr + row_offsets, loss, mask = row_mask)
+pass
 
-    logsumexp = tl.load(logsumexp_ptr + row_idx)
-    y = tl.exp(x.to(tl.float32) - logsumexp)
-    y = tl.where(
-        col_offsets == label_idx,
-        y - 1.0, # exp(x - logsumexp) - 1
-        y,       # exp(x - logsumexp)
-    )
 
-    if DO_LOGIT_SCALING:
-        # d/dx [s * x] = s
-        y = y * LOGIT_SCALE
-    pass
+FLOAT8_E4M3 = getattr(torch, "float8_e4m3fn", None)
+FLOAT8_E4M3_MAX = 448.0
 
-    if DO_SOFTCAPPING:
-        # d/dx [t * tanh(1/t * x)] = 1 - tanh^2(1/t * x)
-        y = y * (1.0 - partial*partial)
-    pass
+def _quantize_fp8_rows(X):
+    """
+    Per row absmax scales map each row onto e4m3's [-448, 448] range.
+    Returns the float8 rows and the float32 scales that dequantize them.
+    """
+    n_rows, n_cols = X.shape
+    X_q   = torch.empty((n_rows, n_cols), dtype = FLOAT8_E4M3,   device = X.device)
+    scale = torch.empty( n_rows,          dtype = torch.float32, device = X.device)
 
-    # If y == 0: dC/dx = 0 ==> we already masked it to be = 0, so dloss = 0.
-    tl.store(logits_ptr + col_offsets, dloss * y, mask = mask)
+    # Quantize about 16M elements at a time, so the temporaries stay small
+    # even for a 128K vocab lm_head.
+    chunk_size = max(1, 2**24 // n_cols)
+    for start in range(0, n_rows, chunk_size):
+        end = min(start + chunk_size, n_rows)
+        x = X[start:end]
+        # Take the reciprocal in float32, and clamp it so all zero or tiny rows
+        # stay finite in X's dtype, ie float16's max of 65504.
+        inverse = (FLOAT8_E4M3_MAX / x.abs().amax(dim = 1).to(torch.float32))
+        inverse = inverse.clamp(max = torch.finfo(X.dtype).max).to(X.dtype)
+        X_q[start:end] = x * inverse[:, None]
+        # Dequantize with exactly the reciprocal we multiplied by, so there is no per row bias
+        scale[start:end] = 1.0 / inverse.to(torch.float32)
+    pass
+    return X_q, scale
 pass
 
 
-MAX_FUSED_SIZE = 65536 # 2**16
-
-class Fast_CrossEntropyLoss(torch.autograd.Function):
+class Fast_LinearCrossEntropyLoss(torch.autograd.Function):
     @staticmethod
-    def forward(ctx, logits, labels, logit_softcapping = 0, logit_scaling = 0):
-        n_rows, vocab_size = logits.shape
+    def forward(ctx, hidden, weight, labels, logit_softcapping = 0, logit_scaling = 0, fp8 = False):
+        n_rows, hidden_size = hidden.shape
+        vocab_size = weight.shape[0]
+        assert(weight.shape[1] == hidden_size)
 
-        div, mod = divmod(vocab_size, MAX_FUSED_SIZE)
-        n_chunks = div + (mod != 0)
+        DO_FP8 = fp8
+        if DO_FP8 and (FLOAT8_E4M3 is None or IS_HIP or torch.cuda.get_device_capability() < (8, 9)):
+            # ROCm's MI300 uses the float8_e4m3fnuz format instead
+            raise RuntimeError(
+                "Unsloth: fp8 = True needs torch.float8_e4m3fn and an NVIDIA GPU "\
+                "with compute capability >= 8.9, ie Ada Lovelace or Hopper."
+            )
+        if DO_FP8:
+            # Only the forward matmul runs in float8. hidden and weight stay in high
+            # precision for the backward, which treats the quantization as identity.
+            hidden_q, hidden_scale = _quantize_fp8_rows(hidden)
+            weight_q, weight_scale = _quantize_fp8_rows(weight)
+        else:
+            hidden_q, weight_q = hidden, weight
+            # Unused
+            hidden_scale = weight_scale = torch.empty(1, dtype = torch.float32, device = "cuda:0")
+        pass
+
+        # The backward recomputes logsumexp per chunk, so only the losses are kept
         losses = torch.empty(n_rows, dtype = torch.float32, device = "cuda:0")
 
         DO_SOFTCAPPING   = (logit_softcapping != 0)
         DO_LOGIT_SCALING = (logit_scaling != 0)
+        DO_INT64         = max(n_rows * hidden.stride(0), vocab_size * weight.stride(0)) >= 2**31
 
-        if n_chunks == 1:
-            # For small vocabs <= 65336 like Llama, Mistral
-            BLOCK_SIZE, num_warps = calculate_settings(vocab_size)
-            logsumexp = torch.empty(n_rows, dtype = torch.float32, device = "cuda:0")
-
-            _cross_entropy_forward[(n_rows,)](
-                logits, logits.stride(0),
-                losses,
-                logsumexp,
-                labels,
-                VOCAB_SIZE       = vocab_size,
-                BLOCK_SIZE       = BLOCK_SIZE,
-                DO_SOFTCAPPING   = DO_SOFTCAPPING,
-                SOFTCAP          = logit_softcapping,
-                DO_LOGIT_SCALING = DO_LOGIT_SCALING,
-                LOGIT_SCALE      = logit_scaling,
-                num_warps        = num_warps,
-            )
-        else:
-            # For large vocabs > 65336 like Gemma 256K
-            logsumexp = torch.empty((n_rows, n_chunks,), dtype = torch.float32, device = "cuda:0")
-
-            _chunked_cross_entropy_forward[(n_rows, n_chunks,)](
-                logits, logits.stride(0),
-                losses,
-                logsumexp,
-                labels,
-                VOCAB_SIZE       = vocab_size,
-                N_CHUNKS         = n_chunks,
-                BLOCK_SIZE       = MAX_FUSED_SIZE,
-                DO_SOFTCAPPING   = DO_SOFTCAPPING,
-                SOFTCAP          = logit_softcapping,
-                DO_LOGIT_SCALING = DO_LOGIT_SCALING,
-                LOGIT_SCALE      = logit_scaling,
-                num_warps        = 32,
-            )
-            # logsumexp(chunked_logsumexp) - x
-            # Do the -x separately
-            logsumexp = torch.logsumexp(logsumexp, dim = 1) # Row sum
-            losses += logsumexp
-            losses.masked_fill_(labels == -100, 0) # Don't forget to mask padding out!
-        pass
+        grid = lambda META: (triton.cdiv(n_rows, META["BLOCK_N"]),)
+        _linear_cross_entropy_forward[grid](
+            hidden_q, hidden_q.stride(0),
+            weight_q, weight_q.stride(0),
+            hidden_scale, hidden_scale.stride(0),
+            weight_scale, weight_scale.stride(0),
+            losses,
+            labels,
+            n_rows,
+            HIDDEN_SIZE      = hidden_size,
+            VOCAB_SIZE       = vocab_size,
+            VOCAB_CLASS      = _vocab_class(vocab_size),
+            ROWS_CLASS       = _rows_class(n_rows),
+            DO_SOFTCAPPING   = DO_SOFTCAPPING,
+            SOFTCAP          = logit_softcapping,
+            DO_LOGIT_SCALING = DO_LOGIT_SCALING,
+            LOGIT_SCALE      = logit_scaling,
+            DO_INT64         = DO_INT64,
+            DO_FP8           = DO_FP8,
+        )
 
-        ctx.save_for_backward(logits, logsumexp, labels)
-        ctx.DO_SOFTCAPPING    = DO_SOFTCAPPING
+        ctx.save_for_backward(hidden, weight, labels)
         ctx.logit_softcapping = logit_softcapping
-        ctx.DO_LOGIT_SCALING  = DO_LOGIT_SCALING
         ctx.logit_scaling     = logit_scaling
         return losses
     pass
 
     @staticmethod
     def backward(ctx, dlosses):
-        logits, logsumexp, labels = ctx.saved_tensors
-        n_rows, vocab_size = logits.shape
+        hidden, weight, labels = ctx.saved_tensors
+        n_rows, hidden_size = hidden.shape
+        vocab_size = weight.shape[0]
 
-        BLOCK_SIZE = 4096
-        div, mod = divmod(vocab_size, BLOCK_SIZE)
-        n_blocks = div + (mod != 0)
+        # lm_head is usually frozen for LoRA, so skip dW if we can
+        DO_DWEIGHT = ctx.needs_input_grad[1]
+        dhidden = torch.empty_like(hidden)
+        # dW sums over every chunk, so accumulate it in float32 and round once at the end
+        dweight = torch.zeros_like(weight, dtype = torch.float32) if DO_DWEIGHT else None
 
-        _cross_entropy_backward[(n_rows, n_blocks,)](
-            logits,   logits.stride(0),
-            dlosses, dlosses.stride(0),
-            logsumexp,
-            labels,
-            VOCAB_SIZE       = vocab_size,
-            BLOCK_SIZE       = BLOCK_SIZE,
-            DO_SOFTCAPPING   = ctx.DO_SOFTCAPPING,
-            SOFTCAP          = ctx.logit_softcapping,
-            DO_LOGIT_SCALING = ctx.DO_LOGIT_SCALING,
-            LOGIT_SCALE      = ctx.logit_scaling,
-            num_warps      = 8,
-        )
-        return logits, None, None, None,
+        # Recompute the logits for a chunk of rows at a time with cuBLAS, so at most
+        # about hidden.numel() logits are alive at once. Each chunk reuses the CE
+        # kernels, and its gradient is folded into dhidden and dW with plain matmuls,
+        # so there are no atomics and the result is deterministic.
+        # At least 128 rows per chunk, so small batches don't run 1 row GEMMs.
+        chunk_size = triton.next_power_of_2(triton.cdiv(n_rows, triton.cdiv(vocab_size, hidden_size)))
+        chunk_size = max(chunk_size, 128)
+        # Each chunk's dW is formed over vocab slices, so its temporary is no bigger than the logits
+        vocab_chunk_size = triton.next_power_of_2(triton.cdiv(chunk_size * vocab_size, hidden_size))
+        for start in range(0, n_rows, chunk_size):
+            end = min(start + chunk_size, n_rows)
+            hidden_chunk = hidden[start:end]
+            labels_chunk = labels[start:end]
+
+            logits = hidden_chunk @ weight.t()
+            # Redo logsumexp from these exact logits, so each row's softmax sums to 1
+            _, logsumexp, launch_config = _cross_entropy_forward_launch(
+                logits, labels_chunk, ctx.logit_softcapping, ctx.logit_scaling,
+            )
+            _cross_entropy_backward_launch(
+                logits, dlosses[start:end], logsumexp, labels_chunk, launch_config,
+                ctx.logit_softcapping, ctx.logit_scaling,
+            )
+            # logits now holds dC/dlogits
+            torch.mm(logits, weight, out = dhidden[start:end])
+            if DO_DWEIGHT:
+                # cuBLAS accumulates each slice in float32 and rounds it once to the weight
+                # dtype. The running sum then stays in float32 across chunks.
+                for v_start in range(0, vocab_size, vocab_chunk_size):
+                    v_end = min(v_start + vocab_chunk_size, vocab_size)
+                    dweight[v_start:v_end].add_(logits[:, v_start:v_end].t() @ hidden_chunk)
+                pass
+            pass
+        pass
+        if DO_DWEIGHT: dweight = dweight.to(weight.dtype)
+        return dhidden, dweight, None, None, None, None,
     pass
 pass
 
 
 @torch._disable_dynamo
-def fast_cross_entropy_loss(
-    logits,
+def fast_linear_cross_entropy(
+    hidden,
+    weight,
     labels,
     logit_softcapping = 0,
     logit_scaling = 0,
     n_items = None,
+    fp8 = False,
 ):
     """
+    Computes cross_entropy(hidden @ weight.T, labels) without ever
+    materializing the (batch*seq_len, vocab_size) logits.
     Arguments:
-        logits: (batch, seq_len, vocab_size)
+        hidden: (batch, seq_len, hidden_size)
+        weight: (vocab_size, hidden_size) ie lm_head.weight
         labels: (batch, seq_len,)
+        fp8: Quantize hidden and weight per row to float8 e4m3 for the forward
+             matmul only. Gradients are straight through, computed from and
+             returned in the high precision hidden / weight dtype.
     Returns:
         losses: float
     """
-    batch, seq_len, d = logits.shape
+    batch, seq_len, d = hidden.shape
     assert(labels.shape == (batch, seq_len))
 
-    loss = Fast_CrossEntropyLoss.apply(
-        logits.view(batch*seq_len, d),
+    # Pass bfloat16 / float16 tensors, even for fp8 = True
+    assert(weight.dtype != FLOAT8_E4M3)
+    # tl.dot needs both operands in the same dtype
+    hidden = hidden.to(weight.dtype).reshape(batch*seq_len, d)
+    loss = Fast_LinearCrossEntropyLoss.apply(
+        hidden.contiguous(),
+        weight.contiguous(),
         labels.view(-1),
         logit_softcapping,
         logit_scaling,
+        fp8,
     )
     if n_items is None:
-        n_items = torch.count_nonzero(labels != -100)
+        return Fast_CrossEntropyLossMean.apply(loss, labels.view(-1))
     return loss.sum() / n_items
 pass
 
@@ -1165,9 +1165,10 @@ def _unsloth_get_batch_samples(self, epoch_iterator, num_batches):
         except StopIteration:
             break
     if len(batch_samples) > 0 and "labels" in batch_samples[0]:
+        from ..kernels import fast_count_valid_labels
         try:
             num_items_in_batch = sum(
-                [torch.count_nonzero(x["labels"][..., 1:] != -100) for x in batch_samples]
+                [fast_count_valid_labels(x["labels"][..., 1:]) for x in batch_samples]
             )
         except TypeError:
             pass